@@ -325,6 +325,8 @@ __C.TEST.POSE_SDF = True
 __C.TEST.POSE_CODEBOOK = False
 __C.TEST.SYNTHESIZE = False
 __C.TEST.ROS_CAMERA = 'camera'
+__C.TEST.ROS_BATCH_SIZE = 1
+__C.TEST.ROS_BATCH_TIMEOUT = 0.02
 __C.TEST.DET_THRESHOLD = 0.5
 __C.TEST.BUILD_CODEBOOK = False
 __C.TEST.IMS_PER_BATCH = 1
@@ -229,7 +229,7 @@ def filter_labels(labels, bboxes):
 
 
 # test a single sample
-def test_sample(sample, network, network_crop):
+def test_sample(sample, network, network_crop, num_images=None):
 
     # construct input
     image = sample['image_color'].cuda()
@@ -245,20 +245,36 @@ def test_sample(sample, network, network_crop):
 
     # run network
     features = network(image, label, depth).detach()
+
+    # drop padding images appended to keep the network input shape fixed
+    if num_images is not None:
+        image = image[:num_images]
+        features = features[:num_images]
+        if depth is not None:
+            depth = depth[:num_images]
+        if label is not None:
+            label = label[:num_images]
+
     out_label, selected_pixels = clustering_features(features, num_seeds=100)
 
     if depth is not None:
         # filter labels on zero depth
         out_label = filter_labels_depth(out_label, depth, 0.8)
 
-    # zoom in refinement
+    # zoom in refinement, one image of the batch at a time
     out_label_refined = None
     if network_crop is not None:
-        rgb_crop, out_label_crop, rois, depth_crop = crop_rois(image, out_label.clone(), depth)
-        if rgb_crop.shape[0] > 0:
-            features_crop = network_crop(rgb_crop, out_label_crop, depth_crop)
-            labels_crop, selected_pixels_crop = clustering_features(features_crop)
-            out_label_refined, labels_crop = match_label_crop(out_label, labels_crop.cuda(), out_label_crop, rois, depth_crop)
+        for i in range(out_label.shape[0]):
+            depth_i = depth[i:i+1] if depth is not None else None
+            rgb_crop, out_label_crop, rois, depth_crop = crop_rois(image[i:i+1], out_label[i:i+1].clone(), depth_i)
+            if rgb_crop.shape[0] > 0:
+                features_crop = network_crop(rgb_crop, out_label_crop, depth_crop)
+                labels_crop, selected_pixels_crop = clustering_features(features_crop)
+                refined, labels_crop = match_label_crop(out_label[i:i+1], labels_crop.cuda(), out_label_crop, rois, depth_crop)
+                # images without crops have no objects, so their initial labels are already final
+                if out_label_refined is None:
+                    out_label_refined = out_label.clone()
+                out_label_refined[i] = refined[0]
 
     if cfg.TEST.VISUALIZE:
         bbox = None
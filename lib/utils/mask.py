@@ -82,27 +82,16 @@ def visualize_segmentation(im, masks, nc=None, return_rgb=False, save_dir=None):
         ax.axis('off')
         fig.add_axes(ax)
 
-    # Mask
-    imgMask = np.zeros(im.shape)
+    # Color lookup table, background stays black
+    w_ratio = .4
+    palette = np.array([c[:3] for c in colors]) * (1 - w_ratio) + w_ratio
+    palette = (palette * 255).round().astype(np.uint8)
+    palette[0] = 0
 
-
-    # Draw color masks
-    for i in np.unique(masks):
-        if i == 0: # background
-            continue
-
-        # Get the color mask
-        color_mask = np.array(colors[i][:3])
-        w_ratio = .4
-        for c in range(3):
-            color_mask[c] = color_mask[c] * (1 - w_ratio) + w_ratio
-        e = (masks == i)
-
-        # Add to the mask
-        imgMask[e] = color_mask
+    # Draw color masks with a single gather
+    imgMask = palette[masks]
 
     # Add the mask to the image
-    imgMask = (imgMask * 255).round().astype(np.uint8)
     im = cv2.addWeighted(im, 0.5, imgMask, 0.5, 0.0)
 
 
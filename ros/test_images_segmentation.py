@@ -10,8 +10,6 @@ import torch
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.utils.data
-import tf
-import rosnode
 import message_filters
 import cv2
 import torch.nn as nn
@@ -24,24 +22,45 @@ import numpy as np
 import _init_paths
 import networks
 import rospy
-import copy
 
+from collections import deque
+from typing import Dict
 from utils.blob import pad_im
 from sensor_msgs.msg import Image, CameraInfo
 from cv_bridge import CvBridge, CvBridgeError
 from fcn.config import cfg, cfg_from_file, get_output_dir
 from fcn.test_dataset import test_sample
 from utils.mask import visualize_segmentation
-lock = threading.Lock()
 
 
-def compute_xyz(depth_img, fx, fy, px, py, height, width):
-    indices = np.indices((height, width), dtype=np.float32).transpose(1,2,0)
-    z_e = depth_img
-    x_e = (indices[..., 1] - px) * z_e / fx
-    y_e = (indices[..., 0] - py) * z_e / fy
-    xyz_img = np.stack([x_e, y_e, z_e], axis=-1) # Shape: [H x W x 3]
-    return xyz_img
+@torch.jit.script
+def prep_color(im_color, depth, u_norm, v_norm, pixel_mean):
+    # type: (torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor) -> Dict[str, torch.Tensor]
+    image_blob = im_color.permute(0, 3, 1, 2).float().div(255.0).sub(pixel_mean)
+    return {'image_color': image_blob.contiguous(memory_format=torch.channels_last)}
+
+
+@torch.jit.script
+def prep_rgbd(im_color, depth, u_norm, v_norm, pixel_mean):
+    # type: (torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor) -> Dict[str, torch.Tensor]
+    sample = prep_color(im_color, depth, u_norm, v_norm, pixel_mean)
+    d = depth.float()
+    xyz = torch.stack([d * u_norm, d * v_norm, d], dim=1) # Shape: [N x 3 x H x W]
+    sample['depth'] = xyz.contiguous(memory_format=torch.channels_last)
+    return sample
+
+
+class HalfPrecisionNetwork(nn.Module):
+    """Runs the network forward under fp16 autocast and returns fp32 features for clustering"""
+
+    def __init__(self, network):
+        super(HalfPrecisionNetwork, self).__init__()
+        self.network = network
+
+    def forward(self, img, label, depth=None):
+        with torch.autocast('cuda', dtype=torch.float16):
+            features = self.network(img, label, depth)
+        return features.float()
 
 
 class ImageListener:
@@ -52,10 +71,29 @@ class ImageListener:
         self.network_crop = network_crop
         self.cv_bridge = CvBridge()
 
-        self.im = None
-        self.depth = None
-        self.rgb_frame_id = None
-        self.rgb_frame_stamp = None
+        # bounded hand-off from the ros callback to the inference thread, holding at most
+        # one batch of the newest frames; older frames are dropped when it is full
+        self._pending = deque(maxlen=cfg.TEST.ROS_BATCH_SIZE)
+        self._pending_lock = threading.Lock()
+        self._frame_ready = threading.Event()
+
+        # release cached gpu blocks only when the reservation gets close to the device limit
+        self.max_reserved = 0.9 * torch.cuda.get_device_properties(cfg.device).total_memory
+
+        # preprocessing specialized for the configured input, resolved once
+        self.use_depth = cfg.INPUT == 'DEPTH' or cfg.INPUT == 'RGBD'
+        self.prep_fn = prep_rgbd if self.use_depth else prep_color
+        self.no_depth = torch.empty(0, device=cfg.device)
+
+        self.pixel_mean_gpu = torch.tensor(cfg.PIXEL_MEANS / 255.0, dtype=torch.float32, device=cfg.device).view(1, 3, 1, 1)
+
+        # resize target and persistent outputs, computed on the first callback and
+        # reused while the incoming image size is unchanged
+        self._depth_f32 = None
+        self._resize_src_shape = None
+        self._target_size = None
+        self._im_resized = None
+        self._depth_resized = None
 
         # initialize a node
         rospy.init_node("seg_rgb")
@@ -68,23 +106,23 @@ class ImageListener:
         if cfg.TEST.ROS_CAMERA == 'D415':
             # use RealSense D435
             self.base_frame = 'measured/base_link'
-            rgb_sub = message_filters.Subscriber('/camera/color/image_raw', Image, queue_size=10)
-            depth_sub = message_filters.Subscriber('/camera/aligned_depth_to_color/image_raw', Image, queue_size=10)
+            rgb_sub = message_filters.Subscriber('/camera/color/image_raw', Image, queue_size=1, buff_size=2**24)
+            depth_sub = message_filters.Subscriber('/camera/aligned_depth_to_color/image_raw', Image, queue_size=1, buff_size=2**24)
             msg = rospy.wait_for_message('/camera/color/camera_info', CameraInfo)
             self.camera_frame = 'measured/camera_color_optical_frame'
             self.target_frame = self.base_frame
         elif cfg.TEST.ROS_CAMERA == 'Azure':
             self.base_frame = 'measured/base_link'
-            rgb_sub = message_filters.Subscriber('/k4a/rgb/image_raw', Image, queue_size=10)
-            depth_sub = message_filters.Subscriber('/k4a/depth_to_rgb/image_raw', Image, queue_size=10)
+            rgb_sub = message_filters.Subscriber('/k4a/rgb/image_raw', Image, queue_size=1, buff_size=2**24)
+            depth_sub = message_filters.Subscriber('/k4a/depth_to_rgb/image_raw', Image, queue_size=1, buff_size=2**24)
             msg = rospy.wait_for_message('/k4a/rgb/camera_info', CameraInfo)
             self.camera_frame = 'rgb_camera_link'
             self.target_frame = self.base_frame
         else:
             # use kinect
             self.base_frame = '%s_rgb_optical_frame' % (cfg.TEST.ROS_CAMERA)
-            rgb_sub = message_filters.Subscriber('/%s/rgb/image_color' % (cfg.TEST.ROS_CAMERA), Image, queue_size=10)
-            depth_sub = message_filters.Subscriber('/%s/depth_registered/image' % (cfg.TEST.ROS_CAMERA), Image, queue_size=10)
+            rgb_sub = message_filters.Subscriber('/%s/rgb/image_color' % (cfg.TEST.ROS_CAMERA), Image, queue_size=1, buff_size=2**24)
+            depth_sub = message_filters.Subscriber('/%s/depth_registered/image' % (cfg.TEST.ROS_CAMERA), Image, queue_size=1, buff_size=2**24)
             msg = rospy.wait_for_message('/%s/rgb/camera_info' % (cfg.TEST.ROS_CAMERA), CameraInfo)
             self.camera_frame = '%s_rgb_optical_frame' % (cfg.TEST.ROS_CAMERA)
             self.target_frame = self.base_frame
@@ -97,19 +135,82 @@ class ImageListener:
         self.py = intrinsics[1, 2]
         print(intrinsics)
 
+        # network input size after rescaling and padding in callback_rgbd
+        self.im_height = msg.height
+        self.im_width = msg.width
+        if cfg.TEST.SCALES_BASE[0] != 1:
+            im_scale = cfg.TEST.SCALES_BASE[0]
+            self.im_height = int(np.ceil(int(round(msg.height * im_scale)) / 16.0) * 16)
+            self.im_width = int(np.ceil(int(round(msg.width * im_scale)) / 16.0) * 16)
+
+        # cached back-projection rays on the gpu, rebuilt lazily if the image size changes
+        self.u_norm_gpu = None
+        self.v_norm_gpu = None
+        self.setup_xyz(self.im_height, self.im_width)
+
         queue_size = 1
         slop_seconds = 0.1
         ts = message_filters.ApproximateTimeSynchronizer([rgb_sub, depth_sub], queue_size, slop_seconds)
         ts.registerCallback(self.callback_rgbd)
 
 
+    def setup_xyz(self, height, width):
+        u_norm = ((np.arange(width, dtype=np.float32) - self.px) / self.fx).astype(np.float32)
+        v_norm = ((np.arange(height, dtype=np.float32) - self.py) / self.fy).astype(np.float32)[:, None]
+        self.u_norm_gpu = torch.as_tensor(u_norm, device=cfg.device)
+        self.v_norm_gpu = torch.as_tensor(v_norm, device=cfg.device)
+
+
+    def check_xyz(self, depth):
+        height, width = depth.shape[-2:]
+        if self.v_norm_gpu is None or self.v_norm_gpu.shape[0] != height or self.u_norm_gpu.shape[0] != width:
+            self.setup_xyz(height, width)
+
+
+    def to_device(self, array):
+        # raw uint8 / float32 frames go up as is, normalization happens on the gpu
+        return torch.from_numpy(np.ascontiguousarray(array)).to(cfg.device)
+
+
+    def label_to_numpy(self, labels, index=0):
+        # clustering returns the labels as float host tensors, mono8 messages need uint8
+        return labels[index].to(torch.uint8).numpy()
+
+
+    def warmup(self):
+        # capture the cuda graph of the full-frame network at the served batch shape before the
+        # ros loop: cuda graph trees only warm up on the first call and record on the second.
+        # the crop network sees one input per object, so it is compiled with dynamic shapes
+        # and traced here for a single crop and for the general batch size
+        with torch.inference_mode():
+            image = torch.zeros((cfg.TEST.ROS_BATCH_SIZE, 3, self.im_height, self.im_width), device=cfg.device)
+            image = image.contiguous(memory_format=torch.channels_last)
+            depth = image.clone() if self.use_depth else None
+            for _ in range(2):
+                self.network(image, None, depth)
+            if self.network_crop is not None:
+                crop_size = cfg.TRAIN.SYN_CROP_SIZE
+                for num_crops in (1, 2):
+                    image_crop = torch.zeros((num_crops, 3, crop_size, crop_size), device=cfg.device)
+                    depth_crop = image_crop.clone() if depth is not None else None
+                    self.network_crop(image_crop, None, depth_crop)
+        torch.cuda.synchronize()
+
+
     def callback_rgbd(self, rgb, depth):
 
         if depth.encoding == '32FC1':
             depth_cv = self.cv_bridge.imgmsg_to_cv2(depth)
         elif depth.encoding == '16UC1':
-            depth_cv = self.cv_bridge.imgmsg_to_cv2(depth).copy().astype(np.float32)
-            depth_cv /= 1000.0
+            # millimeters to meters in a single pass; the persistent buffer is only safe
+            # when the result is consumed by the resize below instead of handed off
+            depth_raw = self.cv_bridge.imgmsg_to_cv2(depth)
+            if cfg.TEST.SCALES_BASE[0] != 1:
+                if self._depth_f32 is None or self._depth_f32.shape != depth_raw.shape:
+                    self._depth_f32 = np.empty(depth_raw.shape, dtype=np.float32)
+                depth_cv = np.multiply(depth_raw, np.float32(1e-3), out=self._depth_f32)
+            else:
+                depth_cv = np.multiply(depth_raw, np.float32(1e-3), dtype=np.float32)
         else:
             rospy.logerr_throttle(
                 1, 'Unsupported depth type. Expected 16UC1 or 32FC1, got {}'.format(
@@ -120,78 +221,127 @@ class ImageListener:
 
         # rescale image if necessary
         if cfg.TEST.SCALES_BASE[0] != 1:
-            im_scale = cfg.TEST.SCALES_BASE[0]
-            im = pad_im(cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR), 16)
-            depth_cv = pad_im(cv2.resize(depth_cv, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_NEAREST), 16)
-
-        with lock:
-            self.im = im.copy()
-            self.depth = depth_cv.copy()
-            self.rgb_frame_id = rgb.header.frame_id
-            self.rgb_frame_stamp = rgb.header.stamp
+            if self._resize_src_shape != im.shape[:2]:
+                im_scale = cfg.TEST.SCALES_BASE[0]
+                height = int(round(im.shape[0] * im_scale))
+                width = int(round(im.shape[1] * im_scale))
+                self._resize_src_shape = im.shape[:2]
+                self._target_size = (width, height)
+                self._im_resized = np.empty((height, width, 3), dtype=np.uint8)
+                self._depth_resized = np.empty((height, width), dtype=np.float32)
+            cv2.resize(im, self._target_size, dst=self._im_resized, interpolation=cv2.INTER_LINEAR)
+            cv2.resize(depth_cv, self._target_size, dst=self._depth_resized, interpolation=cv2.INTER_NEAREST)
+            im = pad_im(self._im_resized, 16)
+            depth_cv = pad_im(self._depth_resized, 16)
+
+        # each message yields freshly allocated arrays that are never written again,
+        # so hand off references instead of copies
+        with self._pending_lock:
+            self._pending.append((im, depth_cv, rgb.header.frame_id, rgb.header.stamp))
+            self._frame_ready.set()
+
+
+    def next_frames(self):
+        # wait for a frame, then give the callback up to ROS_BATCH_TIMEOUT to fill the batch
+        if not self._frame_ready.wait(timeout=0.1):
+            return []
+        deadline = time.time() + cfg.TEST.ROS_BATCH_TIMEOUT
+        while True:
+            with self._pending_lock:
+                if len(self._pending) >= self._pending.maxlen or time.time() >= deadline:
+                    frames = list(self._pending)
+                    self._pending.clear()
+                    self._frame_ready.clear()
+                    return frames
+                self._frame_ready.clear()
+            self._frame_ready.wait(timeout=max(deadline - time.time(), 0))
 
 
     def run_network(self):
 
-        with lock:
-            if listener.im is None:
-              return
-            im_color = self.im.copy()
-            depth_img = self.depth.copy()
-            rgb_frame_id = self.rgb_frame_id
-            rgb_frame_stamp = self.rgb_frame_stamp
+        frames = self.next_frames()
+        if len(frames) == 0:
+            return
 
         print('===========================================')
 
-        # bgr image
-        im = im_color.astype(np.float32)
-        im_tensor = torch.from_numpy(im) / 255.0
-        pixel_mean = torch.tensor(cfg.PIXEL_MEANS / 255.0).float()
-        im_tensor -= pixel_mean
-        image_blob = im_tensor.permute(2, 0, 1)
-        sample = {'image_color': image_blob.unsqueeze(0)}
+        # pad partial batches with the last frame so the network always sees the
+        # warmed-up batch shape and its cuda graph is reused; test_sample only
+        # post-processes the real frames
+        batch = frames + [frames[-1]] * (cfg.TEST.ROS_BATCH_SIZE - len(frames))
+
+        # bgr images and depth, uploaded raw and normalized / back-projected on the gpu
+        im_colors = self.to_device(np.stack([frame[0] for frame in batch]))
+        if self.use_depth:
+            depth_imgs = self.to_device(np.stack([frame[1] for frame in batch]))
+            self.check_xyz(depth_imgs)
+        else:
+            depth_imgs = self.no_depth
+        sample = self.prep_fn(im_colors, depth_imgs, self.u_norm_gpu, self.v_norm_gpu, self.pixel_mean_gpu)
+
+        with torch.inference_mode():
+            out_label, out_label_refined = test_sample(sample, self.network, self.network_crop, len(frames))
+
+        for i, frame in enumerate(frames):
+            self.publish_results(frame, out_label, out_label_refined, i)
+
+        # avoid stalling the stream with empty_cache unless memory is running out
+        if torch.cuda.memory_reserved(cfg.device) > self.max_reserved:
+            torch.cuda.empty_cache()
 
-        if cfg.INPUT == 'DEPTH' or cfg.INPUT == 'RGBD':
-            height = im_color.shape[0]
-            width = im_color.shape[1]
-            xyz_img = compute_xyz(depth_img, self.fx, self.fy, self.px, self.py, height, width)
-            depth_blob = torch.from_numpy(xyz_img).permute(2, 0, 1)
-            sample['depth'] = depth_blob.unsqueeze(0)
 
-        out_label, out_label_refined = test_sample(sample, self.network, self.network_crop)
+    def publish_image(self, pub, array, encoding, frame_id, stamp):
+        msg = self.cv_bridge.cv2_to_imgmsg(array, encoding)
+        msg.header.stamp = stamp
+        msg.header.frame_id = frame_id
+        pub.publish(msg)
+
+
+    def publish_results(self, frame, out_label, out_label_refined, index):
+
+        im_color, depth_img, rgb_frame_id, rgb_frame_stamp = frame
 
         # publish segmentation mask
-        label = out_label[0].cpu().numpy()
-        label_msg = self.cv_bridge.cv2_to_imgmsg(label.astype(np.uint8))
-        label_msg.header.stamp = rgb_frame_stamp
-        label_msg.header.frame_id = rgb_frame_id
-        label_msg.encoding = 'mono8'
-        self.label_pub.publish(label_msg)
-
-        num_object = len(np.unique(label)) - 1
+        label = self.label_to_numpy(out_label, index)
+        self.publish_image(self.label_pub, label, 'mono8', rgb_frame_id, rgb_frame_stamp)
+
+        counts = np.bincount(label.ravel(), minlength=256)
+        num_object = int((counts > 0).sum()) - 1
         print('%d objects' % (num_object))
 
-        if out_label_refined is not None:
-            label_refined = out_label_refined[0].cpu().numpy()
-            label_msg_refined = self.cv_bridge.cv2_to_imgmsg(label_refined.astype(np.uint8))
-            label_msg_refined.header.stamp = rgb_frame_stamp
-            label_msg_refined.header.frame_id = rgb_frame_id
-            label_msg_refined.encoding = 'mono8'
-            self.label_refined_pub.publish(label_msg_refined)
+        # skip refined outputs and overlays nobody is subscribed to
+        publish_label_refined = self.label_refined_pub.get_num_connections() > 0
+        publish_image = self.image_pub.get_num_connections() > 0
+        publish_image_refined = self.image_refined_pub.get_num_connections() > 0
+        if out_label_refined is not None and (publish_label_refined or publish_image_refined):
+            label_refined = self.label_to_numpy(out_label_refined, index)
+        else:
+            publish_label_refined = publish_image_refined = False
+
+        if publish_label_refined:
+            self.publish_image(self.label_refined_pub, label_refined, 'mono8', rgb_frame_id, rgb_frame_stamp)
 
         # publish segmentation images
-        im_label = visualize_segmentation(im_color[:, :, (2, 1, 0)], label, return_rgb=True)
-        rgb_msg = self.cv_bridge.cv2_to_imgmsg(im_label, 'rgb8')
-        rgb_msg.header.stamp = rgb_frame_stamp
-        rgb_msg.header.frame_id = rgb_frame_id
-        self.image_pub.publish(rgb_msg)
+        if publish_image:
+            im_label = visualize_segmentation(im_color[:, :, (2, 1, 0)], label, return_rgb=True)
+            self.publish_image(self.image_pub, im_label, 'rgb8', rgb_frame_id, rgb_frame_stamp)
 
-        if out_label_refined is not None:
+        if publish_image_refined:
             im_label_refined = visualize_segmentation(im_color[:, :, (2, 1, 0)], label_refined, return_rgb=True)
-            rgb_msg_refined = self.cv_bridge.cv2_to_imgmsg(im_label_refined, 'rgb8')
-            rgb_msg_refined.header.stamp = rgb_frame_stamp
-            rgb_msg_refined.header.frame_id = rgb_frame_id
-            self.image_refined_pub.publish(rgb_msg_refined)
+            self.publish_image(self.image_refined_pub, im_label_refined, 'rgb8', rgb_frame_id, rgb_frame_stamp)
+
+
+    def run(self):
+        # inference thread, capture the compiled graphs here before serving frames
+        # any failure here must take the node down instead of leaving it subscribed but silent
+        try:
+            self.warmup()
+            while not rospy.is_shutdown():
+                self.run_network()
+        except Exception as e:
+            rospy.logfatal('segmentation worker failed: {}'.format(e))
+            rospy.signal_shutdown('segmentation worker failed')
+            raise
 
 
 def parse_args():
@@ -248,6 +398,10 @@ if __name__ == '__main__':
         # fix the random seeds (numpy and caffe) for reproducibility
         np.random.seed(cfg.RNG_SEED)
 
+    # expandable segments let the caching allocator grow in place when the refinement
+    # crops change internal tensor sizes, instead of reserving new blocks every frame
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
     # device
     cfg.gpu_id = 0
     cfg.device = torch.device('cuda:{:d}'.format(cfg.gpu_id))
@@ -270,16 +424,31 @@ if __name__ == '__main__':
     network = torch.nn.DataParallel(network, device_ids=[0]).cuda(device=cfg.device)
     cudnn.benchmark = True
     network.eval()
+    network = network.to(memory_format=torch.channels_last)
+    network.module = torch.compile(network.module, mode='reduce-overhead', fullgraph=False)
 
     if args.pretrained_crop:
         network_data_crop = torch.load(args.pretrained_crop)
         network_crop = networks.__dict__[args.network_name](num_classes, cfg.TRAIN.NUM_UNITS, network_data_crop).cuda(device=cfg.device)
         network_crop = torch.nn.DataParallel(network_crop, device_ids=[cfg.gpu_id]).cuda(device=cfg.device)
         network_crop.eval()
+        network_crop = network_crop.to(memory_format=torch.channels_last)
+        # the number of crops changes every frame, so no cuda graphs here
+        network_crop.module = torch.compile(network_crop.module, dynamic=True, fullgraph=False)
     else:
         network_crop = None
 
+    # release the checkpoint staging memory once, not per frame
+    torch.cuda.empty_cache()
+
+    # fp16 for the network forward passes only
+    network = HalfPrecisionNetwork(network)
+    if network_crop is not None:
+        network_crop = HalfPrecisionNetwork(network_crop)
+
     # image listener
     listener = ImageListener(network, network_crop)
-    while not rospy.is_shutdown():
-       listener.run_network()
+    worker = threading.Thread(target=listener.run)
+    worker.daemon = True
+    worker.start()
+    rospy.spin()